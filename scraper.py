@@ -1,72 +1,163 @@
 import sys
 import re
-import json
 import os
-import time
+import asyncio
+import random
 import logging
-import html
+import orjson
+from contextlib import suppress
 from datetime import datetime
-from playwright.sync_api import sync_playwright
-from bs4 import BeautifulSoup
-from urllib.parse import quote_plus, urljoin
+from playwright.async_api import async_playwright, Error as PlaywrightError, TimeoutError as PlaywrightTimeoutError
+from urllib.parse import quote_plus, urlparse
 
 # --- Configuration ---
 DATA_DIR = "data"
 os.makedirs(DATA_DIR, exist_ok=True)
+# Set SCRAPER_DEBUG=1 to dump page HTML into DEBUG_DIR
+DEBUG = os.environ.get("SCRAPER_DEBUG") == "1"
 DEBUG_DIR = os.path.join(DATA_DIR, "debug_html")
-os.makedirs(DEBUG_DIR, exist_ok=True)
+if DEBUG:
+    os.makedirs(DEBUG_DIR, exist_ok=True)
+# Cookies/localStorage from the last successful run, so Bing's consent and
+# first-visit redirects are skipped. Kept out of DATA_DIR, which is committed.
+STATE_PATH = ".browser_state.json"
 
+BASE_URL = "https://www.bing.com/maps/search"
+NAV_RETRIES = 3  # attempts at loading the first results, backing off 1s, 2s, ...
 MAX_SCROLL_ITERATIONS = 20 
+SCROLL_WAIT_TIMEOUT = 2000  # ms to wait for a scroll to load more listings
+USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36"
+VIEWPORT = {"width": 1280, "height": 800}
+# Politeness gap (seconds) between starting concurrent queries against Bing
+QUERY_STAGGER = (1.0, 2.5)
+MAX_CONCURRENCY = 4          # queries (contexts) scraped at the same time
+BROWSER_POOL_SIZE = 4        # most Chromium instances running at once
+OPEN_CONTEXTS_PER_BROWSER = 4  # contexts sharing a browser before another is launched
+CONTEXTS_PER_BROWSER = 100   # contexts served before a browser is relaunched
+
+# CSS selectors for the Bing Maps result list
+LISTING_SELECTOR = "li.listingItem_fPE1q"
+NAME_SELECTOR = "h3.l_magTitle"
+PHONE_SELECTOR = "span.longNum"
+IMAGE_SELECTOR = "img"
+CARD_SELECTOR = "div.b_maglistcard"
+RESULTS_CONTAINER_SELECTOR = "div.b_lstcards"
+
+# Resolves as soon as more listings than the given count are in the DOM
+MORE_LISTINGS_JS = """([selector, count]) => document.querySelectorAll(selector).length > count"""
+
+# Serializes just the result list (or the whole document if it is missing)
+RESULTS_HTML_JS = """(selector) => {
+    const el = document.querySelector(selector) || document.documentElement;
+    return el.outerHTML;
+}"""
+
+# Pulls the fields of the listings after index `start` out of the live DOM,
+# then optionally scrolls for more, all in a single round trip. Only new
+# listings cross the IPC boundary and the page HTML is never re-parsed; the
+# ~1.5 KB data-entity JSON is decoded in the page down to its coordinates.
+EXTRACT_LISTINGS_JS = """([sel, start, scroll]) => {
+    const listings = Array.from(document.querySelectorAll(sel.listing)).slice(start);
+    const items = listings.map((li) => {
+        const text = (s) => {
+            const el = li.querySelector(s);
+            return el ? el.textContent.trim() : null;
+        };
+        const point = () => {
+            const card = li.querySelector(sel.card);
+            const raw = card && card.getAttribute("data-entity");
+            if (!raw) return {};
+            try {
+                const entity = JSON.parse(raw);
+                const geometry = entity.geometry;
+                if (geometry && Object.keys(geometry).length) return geometry;
+                return entity.routablePoint || {};
+            } catch (e) {
+                return {};
+            }
+        };
+        const img = li.querySelector(sel.image);
+        const geo = point();
+        return {
+            name: text(sel.name),
+            phone: text(sel.phone),
+            image: img ? img.getAttribute("src") : null,
+            latitude: geo.y ?? null,
+            longitude: geo.x ?? null,
+        };
+    });
+    if (scroll) {
+        window.scrollTo(0, document.body.scrollHeight);
+    }
+    return items;
+}"""
+LISTING_SELECTORS = {
+    "listing": LISTING_SELECTOR,
+    "name": NAME_SELECTOR,
+    "phone": PHONE_SELECTOR,
+    "image": IMAGE_SELECTOR,
+    "card": CARD_SELECTOR,
+}
+
+# Requests we never need: only the listing DOM is read, so heavy assets and
+# telemetry are aborted before they hit the network. Stylesheets are kept
+# because the scroll-triggered loading of more results depends on layout.
+BLOCKED_RESOURCE_TYPES = {
+    "image", "font", "media", "texttrack",
+    # Chromium's names for sendBeacon/ping and CSP report requests
+    "ping", "cspviolationreport",
+}
+BLOCKED_SCRIPT_HOSTS = ("clarity.ms", "c.bing.com", "c.msn.com")
 
 # Regex for phone numbers
-PHONE_REGEX = re.compile(r'(0\d[\s\-]?\d{2}[\s\-]?\d{2}[\s\-]?\d{2}[\s\-]?\d{2})')
+PHONE_REGEX = re.compile(r'(0\d(?:[\s\-]?\d{2}){4})')
+# Regex for turning a query into a filename
+SAFE_NAME_REGEX = re.compile(r'[^a-z0-9\-]+', re.ASCII)
 
 # Logging
 logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s: %(message)s")
 logger = logging.getLogger(__name__)
 
 def extract_location_data(item):
-    """Extracts data from a Bing Map List Item."""
+    """Builds a result entry from the fields returned by EXTRACT_LISTINGS_JS."""
     data = {
-        "name": None,
-        "phone": None,
+        "name": item["name"],
+        "phone": item["phone"],
         "image": None,
-        "latitude": None,
-        "longitude": None
+        "latitude": item["latitude"],
+        "longitude": item["longitude"]
     }
 
-    name_tag = item.select_one("h3.l_magTitle")
-    if name_tag:
-        data["name"] = name_tag.get_text(strip=True)
-
-    phone_tag = item.select_one("span.longNum")
-    if phone_tag:
-        data["phone"] = phone_tag.get_text(strip=True)
-
-    img_tag = item.select_one("img")
-    if img_tag:
-        src = img_tag.get("src")
-        if src:
-            if src.startswith("//"):
-                src = "https:" + src
-            data["image"] = src
-
-    card_div = item.select_one("div.b_maglistcard")
-    if card_div and card_div.has_attr("data-entity"):
-        raw_json = card_div["data-entity"]
-        try:
-            decoded_json = html.unescape(raw_json)
-            entity_data = json.loads(decoded_json)
-            geometry = entity_data.get("geometry", {})
-            if not geometry:
-                geometry = entity_data.get("routablePoint", {})
-            data["latitude"] = geometry.get("y")
-            data["longitude"] = geometry.get("x")
-        except Exception as e:
-            logger.debug(f"Could not parse location JSON: {e}")
+    src = item["image"]
+    if src:
+        if src.startswith("//"):
+            src = "https:" + src
+        data["image"] = src
 
     return data
 
+def collect_entries(items, results, seen_keys, sink=None):
+    """
+    Turns raw listings into entries and appends the ones that have a name and
+    phone and aren't in seen_keys yet. New entries are also written to `sink`
+    as JSON lines when one is given. Returns how many were added.
+    """
+    added = 0
+    for item in items:
+        entry = extract_location_data(item)
+        if entry["name"] and entry["phone"]:
+            key = (entry["name"], entry["phone"])
+            if key not in seen_keys:
+                seen_keys.add(key)
+                results.append(entry)
+                added += 1
+                logger.debug(f"✅ {entry['name']} | {entry['phone']}")
+                if sink is not None:
+                    sink.write(orjson.dumps(entry) + b"\n")
+    if sink is not None and added:
+        sink.flush()
+    return added
+
 def parse_combined_input(raw_input):
     """
     Splits a string like "hotel&cp=34.00~-6.00" into query and parameters.
@@ -85,33 +176,229 @@ def parse_combined_input(raw_input):
             
     return query, cp, mb
 
-def scrape_bing_maps(raw_input):
+# File stems handed out in this process, so concurrent queries for the same
+# term (e.g. in different places) never share an output file
+_claimed_stems = set()
+
+def claim_output_stem(query):
     """
-    Main scraper function accepting a combined string.
+    Returns a "<query>-maps-<minute>" file stem no other query has taken,
+    adding -2, -3, ... when the plain one is already claimed or on disk
+    (including a checkpoint left behind by a killed run).
+    """
+    safe_name = SAFE_NAME_REGEX.sub('-', query.lower())
+    now = datetime.now().strftime("%Y-%m-%d-%H-%M")
+    base = f"{safe_name}-maps-{now}"
+    stem = base
+    n = 1
+    while stem in _claimed_stems or any(
+        os.path.exists(os.path.join(DATA_DIR, f"{stem}{ext}"))
+        for ext in (".json", ".partial.jsonl")
+    ):
+        n += 1
+        stem = f"{base}-{n}"
+    _claimed_stems.add(stem)
+    return stem
+
+def load_browser_state():
+    """
+    Reads the saved cookies/localStorage, or returns None if there are none
+    or the file is unreadable, so a bad state file never blocks a run.
+    """
+    try:
+        with open(STATE_PATH, "rb") as f:
+            state = orjson.loads(f.read())
+    except FileNotFoundError:
+        return None
+    except (OSError, orjson.JSONDecodeError) as e:
+        logger.warning(f"Ignoring unreadable browser state: {e}")
+        return None
+    if not isinstance(state, dict) or not isinstance(state.get("cookies"), list):
+        logger.warning("Ignoring malformed browser state")
+        return None
+    return state
+
+def save_browser_state(state):
+    """
+    Writes the state to a temp file and swaps it in, so it is never torn.
+    A state of None (the saved one was rejected) deletes the file instead.
+    """
+    if state is None:
+        with suppress(FileNotFoundError):
+            os.remove(STATE_PATH)
+        return
+    tmp_path = f"{STATE_PATH}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(orjson.dumps(state))
+    os.replace(tmp_path, STATE_PATH)
+
+async def block_unneeded_requests(route):
+    """Single route handler that aborts heavy assets and analytics scripts."""
+    request = route.request
+    if request.resource_type in BLOCKED_RESOURCE_TYPES:
+        await route.abort()
+        return
+    if request.resource_type == "script":
+        host = urlparse(request.url).hostname or ""
+        if any(host == h or host.endswith("." + h) for h in BLOCKED_SCRIPT_HOSTS):
+            await route.abort()
+            return
+    await route.continue_()
+
+# --- Browser pool ---
+class BrowserPool:
+    """
+    Hands out one browser context per query from a few lazily launched
+    Chromium instances. Up to max_open contexts share one browser before
+    another is launched. A browser is relaunched after max_uses contexts to
+    keep its memory from drifting over long batches.
+    """
+
+    def __init__(self, size=BROWSER_POOL_SIZE, max_open=OPEN_CONTEXTS_PER_BROWSER,
+                 max_uses=CONTEXTS_PER_BROWSER):
+        self.size = size
+        self.max_open = max_open
+        self.max_uses = max_uses
+        self._playwright = None
+        self._slots = []   # {"browser", "uses", "active"} per launched browser
+        self._owners = {}  # context -> slot it was created on
+        self._lock = asyncio.Lock()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def _launch(self):
+        if self._playwright is None:
+            self._playwright = await async_playwright().start()
+        browser = await self._playwright.chromium.launch(
+            headless=True, 
+            args=['--disable-blink-features=AutomationControlled']
+        )
+        slot = {"browser": browser, "uses": 0, "active": 0}
+        self._slots.append(slot)
+        return slot
+
+    async def _pick_slot(self):
+        """Reserves room on a live browser, launching one if needed."""
+        async with self._lock:
+            # Forget browsers that crashed or were killed underneath us
+            self._slots = [s for s in self._slots if s["browser"].is_connected()]
+            live = [s for s in self._slots if s["uses"] < self.max_uses]
+            open_slots = [s for s in live if s["active"] < self.max_open]
+            slot = max(open_slots, key=lambda s: s["active"], default=None)
+            if slot is None:
+                if len(live) < self.size:
+                    slot = await self._launch()
+                else:
+                    slot = min(live, key=lambda s: s["active"])
+            slot["uses"] += 1
+            slot["active"] += 1
+            return slot
+
+    async def acquire(self, **context_options):
+        """
+        Returns a new context on the busiest browser that still has room,
+        launching another only when every live one is full. If the browser
+        dies under the request, it is dropped and one more is tried.
+        """
+        for attempt in range(2):
+            slot = await self._pick_slot()
+            try:
+                context = await slot["browser"].new_context(**context_options)
+            except Exception:
+                slot["uses"] -= 1
+                slot["active"] -= 1
+                if attempt or slot["browser"].is_connected():
+                    raise
+                logger.warning("Browser disconnected, launching a new one")
+                continue
+            self._owners[context] = slot
+            return context
+
+    async def release(self, context):
+        """Closes the context and retires its browser once it is used up."""
+        slot = self._owners.pop(context)
+        try:
+            await context.close()
+        finally:
+            slot["active"] -= 1
+            if slot["uses"] >= self.max_uses and slot["active"] == 0 and slot in self._slots:
+                self._slots.remove(slot)
+                await slot["browser"].close()
+
+    async def close(self):
+        """Closes every browser and the Playwright driver."""
+        for slot in self._slots:
+            await slot["browser"].close()
+        self._slots.clear()
+        self._owners.clear()
+        if self._playwright is not None:
+            await self._playwright.stop()
+            self._playwright = None
+
+async def load_results(page, url):
+    """
+    Navigates to the search URL and waits for the first listings, retrying
+    with exponential backoff. Returns False if they never show up.
+    """
+    for attempt in range(NAV_RETRIES):
+        try:
+            await page.goto(url, wait_until="commit")
+            await page.wait_for_selector(LISTING_SELECTOR, state="attached", timeout=15000)
+            return True
+        except PlaywrightError as e:
+            if attempt == NAV_RETRIES - 1:
+                return False
+            delay = 2 ** attempt
+            logger.warning(f"Attempt {attempt + 1} failed ({e.message.splitlines()[0]}), retrying in {delay}s")
+            await asyncio.sleep(delay)
+
+async def scrape_query(pool, raw_input, session):
+    """
+    Scrapes a single combined query string in a context taken from the pool.
+    The context starts from session["storage_state"], which is replaced by
+    the context's own state once the query succeeds.
     """
     # 1. Parse the input to get Query, CP, and MB
     query, cp, mb = parse_combined_input(raw_input)
+
+    stem = claim_output_stem(query)
+    filename = f"{stem}.json"
+    filepath = os.path.join(DATA_DIR, filename)
+    # Entries are streamed here as they are found, so a killed run still
+    # leaves its results behind; removed once the JSON file is written
+    partial_path = os.path.join(DATA_DIR, f"{stem}.partial.jsonl")
     
     results = []
-    BASE_URL = "https://www.bing.com/maps/search"
-    
-    headers = {
-        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36"
-    }
+    seen_keys = set()
+    partial = None
 
     try:
         logger.info(f"Parsed Query: {query}")
         if cp: logger.info(f"Using CP: {cp}")
         if mb: logger.info(f"Using MB: {mb}")
 
-        with sync_playwright() as p:
-            browser = p.chromium.launch(
-                headless=True, 
-                args=['--disable-blink-features=AutomationControlled']
-            )
-            page = browser.new_page()
-            page.set_extra_http_headers(headers)
+        context_options = {"user_agent": USER_AGENT, "viewport": VIEWPORT}
+        state = session["storage_state"]
+        try:
+            context = await pool.acquire(storage_state=state, **context_options)
+        except PlaywrightError as e:
+            if state is None:
+                raise
+            # The pool already recovers from dead browsers, so the state is
+            # only to blame if a context without it can be created
+            context = await pool.acquire(storage_state=None, **context_options)
+            logger.warning(f"Saved browser state rejected ({e.message.splitlines()[0]}), starting fresh")
+            if session["storage_state"] is state:
+                session["storage_state"] = None
+
+        try:
+            page = await context.new_page()
             page.set_default_timeout(60000)
+            await page.route("**/*", block_unneeded_requests)
 
             # --- URL CONSTRUCTION ---
             formatted_query = quote_plus(query)
@@ -125,80 +412,133 @@ def scrape_bing_maps(raw_input):
             full_url = f"{BASE_URL}?{'&'.join(params)}"
             logger.info(f"Navigating to: {full_url}")
 
-            page.goto(full_url, wait_until="domcontentloaded")
-
             # --- SCROLLING ---
             logger.info("Waiting for initial results...")
-            try:
-                page.wait_for_selector("li.listingItem_fPE1q", state="attached", timeout=15000)
-            except:
-                logger.warning("Timeout waiting for initial results. Saving debug HTML.")
-                with open(os.path.join(DEBUG_DIR, "initial_debug.html"), "w") as f:
-                    f.write(page.content())
+            if not await load_results(page, full_url):
+                logger.warning("Timeout waiting for initial results.")
+                if DEBUG:
+                    html_content = await page.content()
+                    with open(os.path.join(DEBUG_DIR, f"{stem}.initial.html"), "wb") as f:
+                        f.write(html_content.encode("utf-8"))
                 return [], "no_results"
 
             logger.info("Starting scroll...")
+            partial = open(partial_path, "wb")
             scroll_iterations = 0
             items_loaded_count = 0
             same_count_iterations = 0
 
-            while scroll_iterations < MAX_SCROLL_ITERATIONS:
-                current_items = page.locator("li.listingItem_fPE1q").count()
-                if current_items > items_loaded_count:
-                    logger.info(f"Scroll {scroll_iterations}: Loaded {current_items} items.")
-                    items_loaded_count = current_items
+            # Listings are extracted as they load; the pass after the last
+            # allowed scroll only collects what that scroll brought in
+            while True:
+                more = scroll_iterations < MAX_SCROLL_ITERATIONS
+                try:
+                    new_items = await page.evaluate(
+                        EXTRACT_LISTINGS_JS,
+                        [LISTING_SELECTORS, items_loaded_count, more],
+                    )
+                except PlaywrightError as e:
+                    logger.debug(f"Scroll failed: {e}")
+                    new_items = []
+                if new_items:
+                    items_loaded_count += len(new_items)
+                    collect_entries(new_items, results, seen_keys, sink=partial)
+                    logger.info(f"Scroll {scroll_iterations}: Loaded {items_loaded_count} items.")
                     same_count_iterations = 0
                 else:
                     same_count_iterations += 1
                 
+                if not more:
+                    break
                 if same_count_iterations >= 3:
                     logger.info("Reached end of results.")
                     break
 
                 try:
-                    page.evaluate("window.scrollTo(0, document.body.scrollHeight)")
-                except:
+                    await page.wait_for_function(
+                        MORE_LISTINGS_JS,
+                        arg=[LISTING_SELECTOR, items_loaded_count],
+                        timeout=SCROLL_WAIT_TIMEOUT,
+                    )
+                except PlaywrightTimeoutError:
                     pass
-                time.sleep(2) 
                 scroll_iterations += 1
 
-            # --- PARSING ---
-            logger.info("Parsing HTML...")
-            html_content = page.content()
-            debug_filename = os.path.join(DEBUG_DIR, "bing_maps_final.html")
-            with open(debug_filename, "w", encoding="utf-8") as f:
-                f.write(html_content)
+            logger.info(f"Processed {items_loaded_count} listings.")
 
-            soup = BeautifulSoup(html_content, "html.parser")
-            items = soup.select("li.listingItem_fPE1q")
-            logger.info(f"Found {len(items)} items to process.")
+            if DEBUG:
+                debug_filename = os.path.join(DEBUG_DIR, f"{stem}.final.html")
+                html_content = await page.evaluate(RESULTS_HTML_JS, RESULTS_CONTAINER_SELECTOR)
+                with open(debug_filename, "wb") as f:
+                    f.write(html_content.encode("utf-8"))
 
-            for item in items:
-                entry = extract_location_data(item)
-                if entry["name"] and entry["phone"]:
-                    if entry not in results:
-                        results.append(entry)
-                        logger.info(f"✅ {entry['name']} | {entry['phone']}")
+            session["storage_state"] = await context.storage_state()
+        finally:
+            await pool.release(context)
 
-            browser.close()
-
-    except Exception as e:
+    except Exception:
         logger.exception("Critical Error")
+    finally:
+        if partial is not None:
+            partial.close()
     
     # Save JSON
-    safe_name = re.sub(r'[^a-z0-9\-]+', '-', query.lower())
-    now = datetime.now().strftime("%Y-%m-%d-%H-%M")
-    filename = f"{safe_name}-maps-{now}.json"
-    filepath = os.path.join(DATA_DIR, filename)
-    
     logger.info(f"Saving {len(results)} results to {filepath}")
-    with open(filepath, "w", encoding="utf-8") as f:
-        json.dump(results, f, ensure_ascii=False, indent=2)
+    with open(filepath, "wb") as f:
+        f.write(orjson.dumps(results, option=orjson.OPT_INDENT_2))
+    with suppress(FileNotFoundError):
+        os.remove(partial_path)
 
     return results, filename
 
+async def scrape_many(raw_inputs, max_concurrency=MAX_CONCURRENCY):
+    """
+    Scrapes every query concurrently, one pooled browser context each, with at
+    most max_concurrency queries in flight.
+    """
+    # Stagger the starts so Bing doesn't see a burst of identical sessions
+    delays = [0]
+    for _ in raw_inputs[1:]:
+        delays.append(delays[-1] + random.uniform(*QUERY_STAGGER))
+
+    semaphore = asyncio.Semaphore(max_concurrency)
+    # Loaded once and saved once per batch: queries only read and replace
+    # the in-memory state, never the file itself
+    initial_state = load_browser_state()
+    session = {"storage_state": initial_state}
+
+    async def run_one(pool, raw_input, delay):
+        await asyncio.sleep(delay)
+        async with semaphore:
+            return await scrape_query(pool, raw_input, session)
+
+    # A failing query is returned as its exception instead of cancelling
+    # the others (and closing the pool under them)
+    async with BrowserPool() as pool:
+        outcomes = await asyncio.gather(*[
+            run_one(pool, raw, delay)
+            for raw, delay in zip(raw_inputs, delays)
+        ], return_exceptions=True)
+
+    if session["storage_state"] is not initial_state:
+        save_browser_state(session["storage_state"])
+
+    for raw, outcome in zip(raw_inputs, outcomes):
+        if isinstance(outcome, Exception):
+            logger.error(f"Query {raw!r} failed: {outcome!r}")
+    return outcomes
+
+def scrape_bing_maps(raw_input):
+    """
+    Main scraper function accepting a combined string.
+    """
+    outcome = asyncio.run(scrape_many([raw_input]))[0]
+    if isinstance(outcome, Exception):
+        raise outcome
+    return outcome
+
 if __name__ == "__main__":
-    # Only takes one argument now
-    query_arg = sys.argv[1] if len(sys.argv) > 1 else "restaurant"
-    scrape_bing_maps(query_arg)
+    # Each argument is one combined query; they are scraped concurrently
+    query_args = sys.argv[1:] or ["restaurant"]
+    asyncio.run(scrape_many(query_args))
     logger.info("Job finished.")